@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import click
 import logging
 
@@ -60,12 +61,95 @@ def set(compare_with, older_than, check_every, job_name, dirs):
                   files_older_than=older_than, check_every=check_every)
     truck.save_changes()
 
+@main.command()
+@click.option('-n', '--dry-run', is_flag=True, help='report the differences without saving them')
+@click.argument('jobs_file', type=click.File('r'))
+def apply(dry_run, jobs_file):
+    '''Reconcile all scheduled jobs with those described in JOBS_FILE.
+
+    JOBS_FILE is a JSON (or, if PyYAML is installed, YAML) list of jobs, each with a "name", "dirs",
+    and optionally "compare_with", "older_than", and "check_every" matching the options of the set
+    command. Jobs not listed are removed. Only changed jobs are touched, and the crontab is read and
+    written once regardless of how many jobs are applied.
+    '''
+    if jobs_file.name.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise click.ClickException('PyYAML is required to apply YAML job files')
+        jobs = yaml.safe_load(jobs_file)
+    else:
+        jobs = json.load(jobs_file)
+    run_command_format = sys.argv[0] + ' run %s'
+    truck = GarbageTruck()
+    try:
+        diff = truck.apply_jobs(run_command_format, jobs)
+    except GarbageTruck.InvalidJob as ex:
+        raise click.ClickException(str(ex))
+    for change, sign in (('added', '+'), ('changed', '~'), ('removed', '-')):
+        for name in diff[change]:
+            click.echo('%s %s' % (sign, name))
+    click.echo('%d added, %d changed, %d removed, %d unchanged' %
+               tuple(len(diff[k]) for k in ('added', 'changed', 'removed', 'unchanged')))
+    if not dry_run and (diff['added'] or diff['changed'] or diff['removed']):
+        truck.save_changes()
+
+@main.command()
+@click.option('--compare-with', type=click.Choice(['ctime', 'mtime', 'atime']),
+              default='atime', show_default=True,
+              help='indicate what file timestamp should be used when considering old files')
+@click.option('--older-than', metavar='AGE_COUNT_PERIOD', default='90 days', show_default=True,
+              help='indicate what files should be considered old using relative age like '\
+                   '"14 days", "2 weeks", or "6 months"')
+@click.option('--check-every', metavar='CHECK_COUNT_PERIOD', default='week', show_default=True,
+              help='indicate how often a check would be made to find old files')
+@click.option('--samples', metavar='COUNT', type=int, default=1000, show_default=True,
+              help='maximum number of files to stat while sampling')
+@click.argument('dirs', type=click.Path(exists=True, file_okay=False, resolve_path=True),
+                nargs=-1, required=True)
+def estimate(compare_with, older_than, check_every, samples, dirs):
+    '''Estimate how long a trash job would take on DIRS.
+
+    Randomly samples the directories with a bounded number of file stats to extrapolate the total
+    number of entries, how many files are old, their size, and the expected time to scan them. Warns
+    if the scan is expected to take longer than the CHECK_COUNT_PERIOD schedule.
+    '''
+    if samples < len(dirs):
+        raise click.BadParameter('must be at least the number of DIRS (%d)' % len(dirs),
+                                 param_hint='--samples')
+    truck = GarbageTruck()
+    result = truck.estimate(dirs, compare_with, files_older_than=older_than,
+                            check_every=check_every, samples=samples)
+    click.echo('~%d files in ~%d directories (%d walks, %d stats)' %
+               (result['files'], result['dirs'], result['walks'], result['stats']))
+    click.echo('~%d old files (%.1f%%) holding ~%d bytes' %
+               (result['expired'], result['expired_fraction'] * 100, result['bytes']))
+    click.echo('~%.1f seconds to scan' % result['seconds'])
+    if result['seconds'] > result['period_seconds']:
+        click.secho('Warning: scanning is expected to take longer than checking every %s' %
+                    check_every, fg='yellow', err=True)
+
 @main.command()
 def list():
     '''List all scheduled jobs.'''
     truck = GarbageTruck()
     truck.list_jobs()
 
+@main.command()
+@click.argument('job_names', nargs=-1)
+def stats(job_names):
+    '''Summarize run history and trends of jobs (defaults to all jobs).'''
+    truck = GarbageTruck()
+    for summary in truck.stats_jobs(job_names):
+        if not summary['runs']:
+            click.echo('Job "%s": no recorded runs' % summary['name'])
+            continue
+        trend = '' if summary['trend'] is None else ' trend=%+.1f%%' % summary['trend']
+        click.echo('Job "%(name)s": runs=%(runs)d mean_duration=%(mean_duration).3fs '
+                   'last_duration=%(last_duration).3fs files_per_sec=%(files_per_sec).1f '
+                   'trashed=%(trashed)d bytes=%(bytes)d errors=%(errors)d in_use=%(in_use)d'
+                   % summary + trend)
+
 @main.command()
 @click.argument('job_names', nargs=-1)
 def remove(job_names):
@@ -76,8 +160,10 @@ def remove(job_names):
     truck.save_changes()
 
 @main.command()
+@click.option('--workers', metavar='COUNT', type=int, default=GarbageTruck.DISPOSAL_WORKERS,
+              show_default=True, help='number of threads concurrently moving files to the trash')
 @click.argument('job_id')
-def run(job_id):
+def run(workers, job_id):
     '''Run a trash job.
 
     Usually, this is invoked by the scheduler when it's time to run a trash job. It can also be run
@@ -87,7 +173,47 @@ def run(job_id):
     automatically be directed into a file.
     '''
     truck = GarbageTruck()
-    truck.run_job(job_id)
+    truck.run_job(job_id, workers=workers)
+
+@main.command()
+@click.option('--off', is_flag=True,
+              help='remove the dispatcher and give each job its own crontab entry again')
+@click.option('--check-every', metavar='CHECK_COUNT_PERIOD', default='15 minutes',
+              show_default=True, help='indicate how often the dispatcher should look for due jobs')
+@click.option('--concurrency', metavar='COUNT', type=int, default=2, show_default=True,
+              help='maximum number of jobs the dispatcher runs at the same time')
+@click.option('--jitter', metavar='SECONDS', type=int, default=300, show_default=True,
+              help='maximum random delay before the dispatcher starts each job')
+def dispatcher(off, check_every, concurrency, jitter):
+    '''Schedule all jobs from a single dispatcher crontab entry.
+
+    Instead of one crontab entry per job (where cron may start many jobs at the same minute), a
+    single entry periodically wakes up the dispatcher, which runs only the jobs due based on their
+    last recorded run, staggered by a random jitter and limited to a number of concurrent jobs.
+    '''
+    truck = GarbageTruck()
+    if off:
+        truck.disable_dispatcher(sys.argv[0] + ' run %s')
+    else:
+        dispatch_command = '%s dispatch --concurrency %d --jitter %d' % (
+            sys.argv[0], concurrency, jitter)
+        truck.enable_dispatcher(dispatch_command, check_every=check_every)
+    truck.save_changes()
+
+@main.command()
+@click.option('--concurrency', metavar='COUNT', type=int, default=2, show_default=True,
+              help='maximum number of jobs to run at the same time')
+@click.option('--jitter', metavar='SECONDS', type=int, default=300, show_default=True,
+              help='maximum random delay before starting each job')
+@click.option('--workers', metavar='COUNT', type=int, default=GarbageTruck.DISPOSAL_WORKERS,
+              show_default=True, help='number of threads concurrently moving files to the trash')
+def dispatch(concurrency, jitter, workers):
+    '''Run all trash jobs that are due.
+
+    Usually, this is invoked by the dispatcher crontab entry (see the dispatcher command).
+    '''
+    truck = GarbageTruck()
+    truck.dispatch(concurrency=concurrency, jitter=jitter, workers=workers)
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,43 @@
 import os
 import re
+import sys
+import errno
+import fcntl
+import json
+import time
+import random
+import tempfile
 import logging
+import threading
+
+from queue import Queue, PriorityQueue, Empty
+from past.builtins import basestring
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 from hashlib import md5
+from contextlib import contextmanager
 from configparser import SafeConfigParser
 from datetime import timedelta, datetime
 
 from crontab import CronTab
 from send2trash import send2trash
 
+# send2trash picks a free name in the trash and then renames into it, so two threads trashing files
+# with the same name (or one that could be numbered like it, e.g. "a.log" and "a 2.log") can both
+# pick the same destination and one overwrites the other. These locks are shared by every job run
+# in the process (e.g. by the dispatcher) and striped by the name the trash would derive.
+_TRASH_LOCKS = [threading.Lock() for _ in range(64)]
+_TRASH_NAME_RE = re.compile(r' \d+$')
+
+def _trash_lock_for(path):
+    base_name, ext = os.path.splitext(os.path.basename(path))
+    key = _TRASH_NAME_RE.sub('', base_name) + ext
+    return _TRASH_LOCKS[hash(key) % len(_TRASH_LOCKS)]
+
 # TODO: delete empty directories if moved the last file (do not blindly delete them...)
 
 class GarbageTruck:
@@ -16,11 +45,26 @@ class GarbageTruck:
         '''Indicates when an invalid period is provided'''
         pass
 
+    class InvalidJob(Exception):
+        '''Indicates when an invalid job description is provided'''
+        pass
+
+    DISPOSAL_WORKERS = 4
+    '''Number of threads concurrently sending expired files to the trash during a run'''
+
+    DISPOSAL_QUEUE_SIZE = 1024
+    '''Maximum number of expired paths waiting on disposal (the scan blocks when full)'''
+
+    HISTORY_LIMIT = 100
+    '''Number of most recent run records kept in each job's history file'''
+
     def __init__(self):
         self._logger = logging.getLogger('garbagetruck')
         self._cron = CronTab(user=True)
         self._config = SafeConfigParser()
         self._config_fn = os.path.join(os.path.expanduser('~'), '.garbagetruckrc')
+        self._history_dir = os.path.join(os.path.expanduser('~'), '.garbagetruck', 'history')
+        self._lock_dir = os.path.join(os.path.expanduser('~'), '.garbagetruck', 'locks')
         if os.path.exists(self._config_fn):
             self._config.read(self._config_fn)
 
@@ -44,18 +88,13 @@ class GarbageTruck:
         self._logger.debug('Setting job: %s (%s)', name, section_name)
         # validate that files_older_than syntax is ok now before we schedule things...
         GarbageTruck._period_from(files_older_than)
-        self.remove_job(name)
-        job = self._cron.new(command=run_command_format % section_name,
-                             comment=GarbageTruck._comment_for(name))
         job_period = GarbageTruck._cron_safe_period_from(check_every)
-        smaller_period = GarbageTruck._smaller_period_for(job_period[1])
-        if job_period[0] == 1 and smaller_period:
-            # e.g. if "1 month", set to run on first of every month (or, hour, or minute)
-            period_method = getattr(job, smaller_period)
-            period_method.on(1)
-        else:
-            period_method = getattr(job, job_period[1])
-            period_method.every(job_period[0])
+        self.remove_job(name)
+        if not self.dispatcher_enabled():
+            # with the dispatcher enabled, it decides when jobs are due instead of cron
+            job = self._cron.new(command=run_command_format % section_name,
+                                 comment=GarbageTruck._comment_for(name))
+            GarbageTruck._schedule(job, job_period)
         # replace any pre-existing session
         self._config.remove_section(section_name)
         self._config.add_section(section_name)
@@ -89,7 +128,9 @@ class GarbageTruck:
             self._logger.info('Job %s: name="%s" %s', section_name, name,
                               ' '.join(['%s=%s' % (k,v) for k,v in items.iteritems()]))
             if self._logger.getEffectiveLevel() <= logging.DEBUG:
-                job = next(self._cron.find_comment(GarbageTruck._comment_for(name)))
+                job = next(self._cron.find_comment(GarbageTruck._comment_for(name)), None)
+                if job is None:
+                    job = next(self._cron.find_comment(GarbageTruck._DISPATCHER_COMMENT), None)
                 self._logger.debug(str(job))
 
     def remove_job(self, name):
@@ -104,6 +145,250 @@ class GarbageTruck:
         self._cron.remove_all(comment=GarbageTruck._comment_for(name))
         self._config.remove_section(section_name)
 
+    def apply_jobs(self, run_command_format, jobs):
+        '''Reconcile all jobs against a desired set.
+
+        Jobs present in `jobs` but not yet set are added, jobs whose parameters (or run command)
+        differ are replaced, and jobs not present in `jobs` are removed. Jobs that already match are
+        left untouched. Nothing is written until `save_changes` is called, so a whole fleet of jobs
+        costs a single crontab read and write.
+
+        :param run_command_format: the command called for running job (will interpolate `%s` with a
+                                   job ID)
+        :param jobs: a list of dicts, each holding a `name`, `dirs`, and optionally `compare_with`,
+                     `older_than`, and `check_every` (with the same defaults as `set_job`)
+        :return: a dict of job names listed under `added`, `changed`, `removed`, and `unchanged`
+        '''
+        diff = {'added': [], 'changed': [], 'removed': [], 'unchanged': []}
+        if not isinstance(jobs, list):
+            raise GarbageTruck.InvalidJob('Jobs must be a list')
+        desired = {}
+        # validate everything before changing anything so a bad spec never leaves a partial apply
+        for spec in jobs:
+            GarbageTruck._validate_job_spec(spec)
+            if spec['name'] in desired:
+                raise GarbageTruck.InvalidJob('Duplicate job name: ' + spec['name'])
+            desired[spec['name']] = spec
+        for section_name in self._config.sections():
+            name = self._config.get(section_name, 'name')
+            if name not in desired:
+                self.remove_job(name)
+                diff['removed'].append(name)
+        for name, spec in sorted(desired.items()):
+            # same normalization as click.Path(resolve_path=True) in the set command
+            dirs = [os.path.realpath(os.path.expanduser(d)) for d in spec['dirs']]
+            kwargs = {
+                'compare_with': spec.get('compare_with', 'atime'),
+                'files_older_than': spec.get('older_than', '90 days'),
+                'check_every': spec.get('check_every', 'week'),
+            }
+            section_name = GarbageTruck._section_name_for(name)
+            if not self._config.has_section(section_name):
+                diff['added'].append(name)
+            elif self._job_matches(run_command_format, name, dirs, **kwargs):
+                diff['unchanged'].append(name)
+                continue
+            else:
+                diff['changed'].append(name)
+            self.set_job(run_command_format, name, dirs, **kwargs)
+        return diff
+
+    def dispatcher_enabled(self):
+        '''Indicate if jobs are scheduled by a single dispatcher instead of one cron entry each.'''
+        return any(True for _ in self._cron.find_comment(GarbageTruck._DISPATCHER_COMMENT))
+
+    def enable_dispatcher(self, dispatch_command, check_every='15 minutes'):
+        '''Schedule all jobs from a single dispatcher cron entry.
+
+        Replaces every job's cron entry with one entry calling `dispatch_command`, which is expected
+        to end up in `dispatch`. Each time the dispatcher wakes up, it runs only the jobs that are
+        due based on their last recorded run, spreading load instead of having cron start every job
+        at the same minute.
+
+        :param dispatch_command: the command called to run the dispatcher
+        :param check_every: the period to use for when to wake up the dispatcher
+        '''
+        job_period = GarbageTruck._cron_safe_period_from(check_every)
+        self._logger.debug('Enabling dispatcher: %s', dispatch_command)
+        self._cron.remove_all(comment=GarbageTruck._DISPATCHER_COMMENT)
+        for section_name in self._config.sections():
+            name = self._config.get(section_name, 'name')
+            self._cron.remove_all(comment=GarbageTruck._comment_for(name))
+        job = self._cron.new(command=dispatch_command, comment=GarbageTruck._DISPATCHER_COMMENT)
+        GarbageTruck._schedule(job, job_period)
+
+    def disable_dispatcher(self, run_command_format):
+        '''Remove the dispatcher and go back to an individual cron entry for each job.
+
+        :param run_command_format: the command called for running job (will interpolate `%s` with a
+                                   job ID)
+        '''
+        self._logger.debug('Disabling dispatcher')
+        self._cron.remove_all(comment=GarbageTruck._DISPATCHER_COMMENT)
+        for section_name in self._config.sections():
+            options = dict(self._config.items(section_name))
+            self.set_job(run_command_format, options['name'], self._get_dirs(section_name),
+                         options['compare_with'], files_older_than=options['files_older_than'],
+                         check_every=options['check_every'])
+
+    def due_jobs(self, now=None):
+        '''Find the jobs due to be run.
+
+        A job is due when it is not currently running and it has never been run or its last
+        recorded run started at least its `check_every` period ago.
+
+        :param now: the time to compare against (defaults to the current time)
+        :return: a list of job IDs, most overdue first
+        '''
+        now = now or datetime.now()
+        due = []
+        for section_name in self._config.sections():
+            name = self._config.get(section_name, 'name')
+            period = GarbageTruck._delta_safe_period_from(self._config.get(section_name,
+                                                                           'check_every'))
+            history = self.job_history(name)
+            if history:
+                last_run = datetime.strptime(history[-1]['started'][:19], '%Y-%m-%dT%H:%M:%S')
+                next_run = last_run + timedelta(**{period[1]: period[0]})
+            else:
+                next_run = datetime.min
+            if next_run <= now and not self._job_running(section_name):
+                due.append((next_run, section_name))
+        return [section_name for _, section_name in sorted(due)]
+
+    def dispatch(self, concurrency=2, jitter=300, workers=DISPOSAL_WORKERS):
+        '''Run all due jobs.
+
+        Not normally called directly, this is what the dispatcher cron entry runs. Due jobs are run
+        by at most `concurrency` threads. Each job is given a random start time within `jitter`
+        seconds so that runs do not all hit the disks at once, and jobs are started in order of
+        those times (a job may start later than its time when all threads are busy with others).
+        Only one dispatcher runs at a time: if a previous one is still busy, this one returns
+        immediately and leaves the work to it.
+
+        :param concurrency: the maximum number of jobs running at the same time
+        :param jitter: the maximum number of seconds to delay the start of each job
+        :param workers: the number of disposal threads used by each job
+        '''
+        with self._lock('dispatch') as locked:
+            if not locked:
+                self._logger.info('Skipping dispatch: Another dispatcher is still running')
+                return
+            started = time.time()
+            pending = PriorityQueue()
+            for section_name in self.due_jobs():
+                pending.put((started + random.uniform(0, max(0, jitter)), section_name))
+            self._logger.debug('Dispatching %d due jobs', pending.qsize())
+
+            def runner():
+                while True:
+                    try:
+                        start_at, section_name = pending.get_nowait()
+                    except Empty:
+                        return
+                    delay = start_at - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    try:
+                        self.run_job(section_name, workers=workers)
+                    except Exception:
+                        self._logger.exception('Job %s failed', section_name)
+            threads = [threading.Thread(target=runner) for _ in range(max(1, concurrency))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    def estimate(self, dirs, compare_with='atime', files_older_than='90 days', check_every='week',
+                 samples=1000):
+        '''Estimate the size of directories and the cost of running a job on them.
+
+        Makes random walks from each directory down to a leaf, counting the entries of each visited
+        directory and stat-ing a few random files in it, until `samples` files have been stat-ed.
+        Each directory is listed, and each sampled file stat-ed, at most once across all walks.
+        Counts are extrapolated using the branching factor along each walk (Knuth's estimator), and
+        the runtime is extrapolated from the measured rate of reading directories and stat-ing
+        files.
+
+        :param dirs: a list of directories to estimate
+        :param compare_with: the os.path time function to use when considering old files
+        :param files_older_than: the period to use to determine what "old" is for each file
+        :param check_every: the period a job would be scheduled to run with
+        :param samples: the maximum number of files to stat
+        :return: a dict of the estimated number of `files`, `dirs`, `expired` files, their `bytes`,
+                 the `expired_fraction`, the expected scan `seconds`, and the `period_seconds`
+                 between checks (along with the number of `walks` and `stats` made)
+        '''
+        job_period = GarbageTruck._cron_safe_period_from(check_every)
+        period = GarbageTruck._delta_safe_period_from(files_older_than)
+        delta = timedelta(**{period[1]: period[0]})
+        oldest_time = time.mktime((datetime.now() - delta).timetuple())
+        compare_with = 'st_' + compare_with
+        result = {'files': 0.0, 'dirs': 0.0, 'expired': 0.0, 'bytes': 0.0, 'walks': 0, 'stats': 0}
+        listed = list_seconds = stat_seconds = 0.0
+        listings = {}  # each directory is only listed once, however many walks pass through it
+        checked = {}  # each sampled file is only stat-ed once: (expired, size) or None
+        for index, dirname in enumerate(dirs):
+            # every directory gets at least one walk, even when samples < len(dirs)
+            budget = max(1, (samples - result['stats']) // (len(dirs) - index))
+            totals = {'files': 0.0, 'dirs': 0.0, 'expired': 0.0, 'bytes': 0.0}
+            walks = stats = 0
+            while stats < budget and walks < budget:
+                walks += 1
+                weight = 1.0
+                dirpath = dirname
+                while dirpath:
+                    if dirpath not in listings:
+                        started = time.time()
+                        try:
+                            listings[dirpath] = self._sample_dir(dirpath)
+                        except OSError as ex:
+                            self._logger.warn('Unable to read %s: %s', dirpath, ex)
+                            listings[dirpath] = None
+                        list_seconds += time.time() - started
+                        if listings[dirpath]:
+                            listed += listings[dirpath][0] + listings[dirpath][2]
+                    if listings[dirpath] is None:
+                        break
+                    nfiles, files, ndirs, subdirs = listings[dirpath]
+                    totals['files'] += weight * nfiles
+                    totals['dirs'] += weight * ndirs
+                    files = random.sample(files, min(len(files),
+                                                     GarbageTruck._SAMPLED_FILES_PER_DIR))
+                    sampled = []
+                    for curpath in files:
+                        if curpath not in checked:
+                            if stats >= budget:
+                                break
+                            started = time.time()
+                            try:
+                                st = os.stat(curpath)
+                                checked[curpath] = (getattr(st, compare_with) < oldest_time and
+                                                    st.st_mtime < oldest_time, st.st_size)
+                            except OSError:
+                                checked[curpath] = None
+                            stat_seconds += time.time() - started
+                            stats += 1
+                        sampled.append(checked[curpath])
+                    for check in sampled:
+                        if check and check[0]:
+                            totals['expired'] += weight * nfiles / len(sampled)
+                            totals['bytes'] += weight * nfiles / len(sampled) * check[1]
+                    weight *= ndirs
+                    dirpath = random.choice(subdirs) if subdirs else None
+            for key, value in totals.items():
+                result[key] += value / max(1, walks)
+            result['walks'] += walks
+            result['stats'] += stats
+        result['expired_fraction'] = result['expired'] / result['files'] if result['files'] else 0.0
+        result['seconds'] = 0.0
+        if listed:
+            result['seconds'] += (result['files'] + result['dirs']) * list_seconds / listed
+        if checked:
+            result['seconds'] += result['files'] * stat_seconds / len(checked)
+        result['period_seconds'] = job_period[0] * GarbageTruck._PERIOD_SECONDS[job_period[1]]
+        return result
+
     def save_changes(self):
         '''Save all changes made to the GarbageTruck.
 
@@ -112,43 +397,125 @@ class GarbageTruck:
         '''
         self._logger.debug('Saving: %s', self._config_fn)
         self._cron.write()
-        with open(self._config_fn, 'wb') as configfile:
+        with open(self._config_fn, 'w') as configfile:
             self._config.write(configfile)
 
-    def run_job(self, id):
+    def run_job(self, id, workers=DISPOSAL_WORKERS):
         '''Run a job.
 
         Runs a job added by `set_job`. Not normally called directly, this is what is used when run
         from the job scheduler on the configured interval.
 
+        Scanning and disposal overlap: the directory walk feeds expired paths into a bounded queue
+        drained by `workers` threads calling send2trash. Files currently held open by any process
+        (where `/proc` is available) or modified within the job's age period are never trashed.
+        If the same job is still running (e.g. a slow previous run), this run is skipped.
+
         :param id: the unique identifier assigned to a job (this is **not** the name of the job).
+        :param workers: the number of disposal threads to use
         '''
         section_name = id
         if not self._config.has_section(section_name):
             self._logger.warn('Unable to run job %s: Does not exist', section_name)
             return
         name = self._config.get(section_name, 'name')
-        self._logger.debug('Running: %s (%s)', name, section_name)
-        compare_with = self._config.get(section_name, 'compare_with')
-        compare_with_func = getattr(os.path, 'get' + compare_with)
-        files_older_than = self._config.get(section_name, 'files_older_than')
-        period = GarbageTruck._delta_safe_period_from(files_older_than)
-        kwargs = {period[1]: period[0]}
-        delta = timedelta(**kwargs)
-        for dirname in self._get_dirs(section_name):
-            self._run_job(compare_with_func, delta, dirname)
+        with self._lock(section_name) as locked:
+            if not locked:
+                self._logger.warn('Skipping job %s: Still running', name)
+                return
+            self._logger.debug('Running: %s (%s)', name, section_name)
+            compare_with = 'st_' + self._config.get(section_name, 'compare_with')
+            files_older_than = self._config.get(section_name, 'files_older_than')
+            period = GarbageTruck._delta_safe_period_from(files_older_than)
+            kwargs = {period[1]: period[0]}
+            delta = timedelta(**kwargs)
+            started = time.time()
+            record = {'started': datetime.fromtimestamp(started).isoformat(),
+                      'scanned': 0, 'trashed': 0, 'bytes': 0, 'errors': 0, 'in_use': 0}
+            open_files = self._open_files()
+            for dirname in self._get_dirs(section_name):
+                for key, value in self._run_job(compare_with, delta, dirname, workers,
+                                                open_files).items():
+                    record[key] += value
+            record['duration'] = round(time.time() - started, 3)
+            self._record_run(section_name, record)
+
+    def job_history(self, name):
+        '''Get the recorded runs of a job.
+
+        Each call to `run_job` appends a record holding the `started` time, `duration` in seconds,
+        and the number of files `scanned`, `trashed`, `bytes` trashed, `errors` encountered, and
+        expired files skipped for being `in_use`.
+        Only the most recent `HISTORY_LIMIT` records are kept.
+
+        :param name: the unique name used when the job was created
+        :return: a list of run records, oldest first
+        '''
+        return self._read_history(GarbageTruck._section_name_for(name))
+
+    def stats_jobs(self, names=None):
+        '''Summarize the run history of jobs.
+
+        For each job, reports the number of `runs`, the `mean_duration` and `last_duration` in
+        seconds, throughput in `files_per_sec` scanned, the total number of files `trashed`, `bytes`
+        trashed, `errors`, and `in_use` files skipped, and the `trend` as the percentage change in
+        mean duration of the most recent half of the runs compared with the earlier half (a growing
+        tree shows up as a positive trend, `None` until there are enough runs).
+
+        :param names: the job names to summarize (defaults to all jobs)
+        :return: a list of summary dicts, one per job, each including the job `name`
+        '''
+        if not names:
+            names = [self._config.get(s, 'name') for s in self._config.sections()]
+        summaries = []
+        for name in names:
+            history = self.job_history(name)
+            summary = {'name': name, 'runs': len(history)}
+            summaries.append(summary)
+            if not history:
+                continue
+            durations = [r['duration'] for r in history]
+            scanned = sum(r['scanned'] for r in history)
+            half = len(history) // 2
+            summary['trend'] = None
+            if half > 0:
+                earlier = sum(durations[:half]) / half
+                recent = sum(durations[-half:]) / half
+                if earlier > 0:
+                    summary['trend'] = (recent - earlier) * 100.0 / earlier
+            summary['mean_duration'] = sum(durations) / len(durations)
+            summary['last_duration'] = durations[-1]
+            summary['files_per_sec'] = scanned / sum(durations) if sum(durations) > 0 else 0.0
+            for key in ('trashed', 'bytes', 'errors', 'in_use'):
+                summary[key] = sum(r.get(key, 0) for r in history)
+        return summaries
 
     ######################################################################
     # private
 
     @staticmethod
     def _section_name_for(name):
-        return md5(name).hexdigest()
+        return md5(name.encode('utf-8')).hexdigest()
 
     @staticmethod
     def _comment_for(name):
         return 'GarbageTruck: ' + name
 
+    _DISPATCHER_COMMENT = 'GarbageTruck dispatcher'
+
+    @staticmethod
+    def _schedule(job, job_period):
+        smaller_period = GarbageTruck._smaller_period_for(job_period[1])
+        if job_period[0] == 1 and smaller_period:
+            # e.g. if "1 month", set to run on first of every month (or, hour, or minute)
+            period_method = getattr(job, smaller_period)
+            period_method.on(1)
+        else:
+            period_method = getattr(job, job_period[1])
+            period_method.every(job_period[0])
+
+    _PERIOD_UNITS = ('second', 'minute', 'hour', 'day', 'week', 'month', 'year')
+
     _PERIOD_RE = re.compile('^\s*(\d*)\s*(.+?)s?\s*$')
     @staticmethod
     def _period_from(str):
@@ -157,6 +524,8 @@ class GarbageTruck:
             raise GarbageTruck.InvalidPeriod("Unable to parse period from " + str)
         period = list(match.groups())
         period[0] = 1 if period[0] == '' else int(period[0])
+        if period[1] not in GarbageTruck._PERIOD_UNITS:
+            raise GarbageTruck.InvalidPeriod('Unknown period unit in ' + str)
         return period
 
     @staticmethod
@@ -167,6 +536,8 @@ class GarbageTruck:
             period[1] = 'day'
         elif period[1] == 'year':
             raise GarbageTruck.InvalidPeriod('Check schedule must be less than a year')
+        elif period[1] == 'second':
+            raise GarbageTruck.InvalidPeriod('Check schedule must be at least a minute')
         return period
 
     @staticmethod
@@ -182,6 +553,9 @@ class GarbageTruck:
             period[1] += 's'
         return period
 
+    _PERIOD_SECONDS = {'minute': 60, 'hour': 60 * 60, 'day': 24 * 60 * 60,
+                       'month': 30 * 24 * 60 * 60}
+
     @staticmethod
     def _smaller_period_for(period):
         return {'hour': 'minute', 'day': 'hour', 'month': 'day'}.get(period)
@@ -196,20 +570,286 @@ class GarbageTruck:
                 return dirs
             dirs.append(self._config.get(section_name, optname))
 
-    def _run_job(self, compare_with_func, delta, dirname):
+    _COMPARE_WITH = ('atime', 'mtime', 'ctime')
+
+    @staticmethod
+    def _validate_job_spec(spec):
+        if not isinstance(spec, dict):
+            raise GarbageTruck.InvalidJob('Jobs must be mappings: %r' % (spec,))
+        if not isinstance(spec.get('name'), basestring) or not spec['name']:
+            raise GarbageTruck.InvalidJob('Jobs must have a name: %r' % (spec,))
+        name = spec['name']
+        unknown = set(spec) - set(['name', 'dirs', 'compare_with', 'older_than', 'check_every'])
+        if unknown:
+            raise GarbageTruck.InvalidJob('Unknown job keys for %s: %s' %
+                                          (name, ', '.join(sorted(unknown))))
+        dirs = spec.get('dirs')
+        if not isinstance(dirs, list) or not dirs or \
+                not all(isinstance(d, basestring) and d for d in dirs):
+            raise GarbageTruck.InvalidJob('Job %s must have a list of dirs: %r' % (name, dirs))
+        if spec.get('compare_with', 'atime') not in GarbageTruck._COMPARE_WITH:
+            raise GarbageTruck.InvalidJob('Job %s must compare with one of %s: %r' %
+                                          (name, ', '.join(GarbageTruck._COMPARE_WITH),
+                                           spec['compare_with']))
+        for key, parse in (('older_than', GarbageTruck._delta_safe_period_from),
+                           ('check_every', GarbageTruck._cron_safe_period_from)):
+            value = spec.get(key, '')
+            if key in spec and not isinstance(value, basestring):
+                raise GarbageTruck.InvalidJob('Job %s has an invalid %s: %r' % (name, key, value))
+            if key in spec:
+                try:
+                    parse(value)
+                except GarbageTruck.InvalidPeriod as ex:
+                    raise GarbageTruck.InvalidJob('Job %s has an invalid %s: %s' % (name, key, ex))
+
+    def _job_matches(self, run_command_format, name, dirs,
+                     compare_with, files_older_than, check_every):
+        section_name = GarbageTruck._section_name_for(name)
+        current = dict(self._config.items(section_name))
+        expected = {'name': name, 'compare_with': compare_with,
+                    'files_older_than': files_older_than, 'check_every': check_every}
+        for count, dirname in enumerate(dirs, 1):
+            expected['dir' + str(count)] = dirname
+        if current != expected:
+            return False
+        commands = [job.command for job in self._cron.find_comment(GarbageTruck._comment_for(name))]
+        if self.dispatcher_enabled():
+            return commands == []
+        return commands == [run_command_format % section_name]
+
+    _SAMPLED_FILES_PER_DIR = 5
+    _DIR_RESERVOIR_SIZE = 64
+
+    def _sample_dir(self, dirpath):
+        # Count the entries of a directory while keeping a random sample of its files and
+        # subdirectories (reservoir sampling, so huge directories are never held in memory).
+        reservoirs = ([], [])
+        counts = [0, 0]
+        for entry in scandir(dirpath):
+            try:
+                is_dir = entry.is_dir()
+                if is_dir and entry.is_symlink():
+                    continue
+            except OSError:
+                continue
+            kind = 1 if is_dir else 0
+            counts[kind] += 1
+            if len(reservoirs[kind]) < GarbageTruck._DIR_RESERVOIR_SIZE:
+                reservoirs[kind].append(entry.path)
+            else:
+                index = random.randrange(counts[kind])
+                if index < GarbageTruck._DIR_RESERVOIR_SIZE:
+                    reservoirs[kind][index] = entry.path
+        return counts[0], reservoirs[0], counts[1], reservoirs[1]
+
+    def _history_fn_for(self, section_name):
+        return os.path.join(self._history_dir, section_name + '.jsonl')
+
+    @contextmanager
+    def _lock(self, lock_name):
+        # A non-blocking exclusive flock: yields False when another process (or thread) holds it.
+        if not os.path.exists(self._lock_dir):
+            try:
+                os.makedirs(self._lock_dir)
+            except OSError:
+                if not os.path.isdir(self._lock_dir):
+                    raise
+        with open(os.path.join(self._lock_dir, lock_name + '.lock'), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _job_running(self, section_name):
+        with self._lock(section_name) as locked:
+            return not locked
+
+    def _read_history(self, section_name):
+        history_fn = self._history_fn_for(section_name)
+        history = []
+        if not os.path.exists(history_fn):
+            return history
+        with open(history_fn) as history_file:
+            for line in history_file:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    if line.strip():
+                        self._logger.debug('Ignoring unreadable history line: %r', line)
+        return history
+
+    def _record_run(self, section_name, record):
+        history_fn = self._history_fn_for(section_name)
+        if not os.path.exists(self._history_dir):
+            os.makedirs(self._history_dir)
+        history = self._read_history(section_name) + [record]
+        lines = [json.dumps(r, sort_keys=True) + '\n' for r in history]
+        # replace the history atomically so overlapping runs or a crash never leave a partial line
+        fd, tmp_fn = tempfile.mkstemp(dir=self._history_dir, prefix='.' + section_name)
+        try:
+            with os.fdopen(fd, 'w') as history_file:
+                history_file.writelines(lines[-GarbageTruck.HISTORY_LIMIT:])
+            os.rename(tmp_fn, history_fn)
+        except Exception:
+            os.remove(tmp_fn)
+            raise
+
+    def _open_files(self):
+        # Collect the (device, inode) of every file held open by a process we can inspect, once
+        # per run, instead of asking lsof about each candidate.
+        open_files = set()
+        if not os.path.isdir('/proc'):
+            return open_files
+        started = time.time()
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            fd_dir = os.path.join('/proc', pid, 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue  # exited or owned by another user
+            for fd in fds:
+                try:
+                    st = os.stat(os.path.join(fd_dir, fd))
+                except OSError:
+                    continue
+                open_files.add((st.st_dev, st.st_ino))
+        self._logger.debug('Found %d open files in %.3fs', len(open_files), time.time() - started)
+        return open_files
+
+    def _run_job(self, compare_with, delta, dirname, workers=DISPOSAL_WORKERS,
+                 open_files=frozenset()):
+        stats = {'scanned': 0, 'trashed': 0, 'bytes': 0, 'errors': 0, 'in_use': 0}
         if not os.path.exists(dirname):
             self._logger.warn('Ignoring %s: Does not exist', dirname)
+            return stats
+        oldest_time = time.mktime((datetime.now() - delta).timetuple())
+        self._logger.debug('Checking %s for files older than %s', dirname,
+                           datetime.fromtimestamp(oldest_time))
+        self._ensure_trash_dirs()
+        disposal = Queue(maxsize=GarbageTruck.DISPOSAL_QUEUE_SIZE)
+        results = []
+        threads = []
+        for _ in range(max(1, workers)):
+            thread = threading.Thread(target=self._dispose_from, args=(disposal, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for curpath, st in self._scan(dirname, stats):
+                stats['scanned'] += 1
+                # a file still being written (e.g. on a noatime mount) can have an old atime
+                if getattr(st, compare_with) >= oldest_time or st.st_mtime >= oldest_time:
+                    continue
+                if (st.st_dev, st.st_ino) in open_files:
+                    self._logger.debug('Skipping open file: %s', curpath)
+                    stats['in_use'] += 1
+                    continue
+                disposal.put((curpath, st.st_size))
+        finally:
+            for _ in threads:
+                disposal.put(None)
+            for thread in threads:
+                thread.join()
+        for result in results:
+            for key, value in result.items():
+                stats[key] += value
+        if stats['trashed'] > 0:
+            self._logger.info('Cleaned up %d files', stats['trashed'])
+        return stats
+
+    _SCAN_OPEN_DIRS = 64
+
+    def _scan(self, dirname, stats):
+        # Unlike os.walk, never build a list of a directory's entries: each directory is read
+        # lazily and subdirectories are descended into as soon as they are found, so memory is
+        # bounded by the depth of the tree instead of the width of its largest directory. To bound
+        # open descriptors too, only _SCAN_OPEN_DIRS directories along the current path are kept
+        # open; subdirectories found deeper than that are remembered by path and scanned later.
+        pending = []
+        spilled = [dirname]
+        try:
+            while pending or spilled:
+                if not pending:
+                    self._open_scan(spilled.pop(), pending, stats)
+                    continue
+                dirpath, entries = pending[-1]
+                try:
+                    entry = next(entries)
+                except (StopIteration, OSError) as ex:
+                    if isinstance(ex, OSError):
+                        self._logger.warn('Unable to read %s: %s', dirpath, ex)
+                        stats['errors'] += 1
+                    pending.pop()
+                    GarbageTruck._close_scan(entries)
+                    continue
+                try:
+                    if entry.is_dir():
+                        # like os.walk, do not descend into symlinked directories
+                        if entry.is_symlink():
+                            continue
+                        if len(pending) < GarbageTruck._SCAN_OPEN_DIRS:
+                            self._open_scan(entry.path, pending, stats)
+                        else:
+                            spilled.append(entry.path)
+                        continue
+                    st = entry.stat()
+                except OSError as ex:
+                    self._logger.warn('Unable to check %s: %s', entry.path, ex)
+                    stats['errors'] += 1
+                    continue
+                yield entry.path, st
+        finally:
+            # also reached when the generator is abandoned (closed) mid-scan
+            for _, entries in pending:
+                GarbageTruck._close_scan(entries)
+
+    def _open_scan(self, dirpath, pending, stats):
+        try:
+            pending.append((dirpath, scandir(dirpath)))
+        except OSError as ex:
+            self._logger.warn('Unable to read %s: %s', dirpath, ex)
+            stats['errors'] += 1
+
+    @staticmethod
+    def _close_scan(entries):
+        if hasattr(entries, 'close'):
+            entries.close()
+
+    def _ensure_trash_dirs(self):
+        # Create the home trash (as send2trash locates it on freedesktop systems) up front so the
+        # disposal threads do not race each other creating it.
+        if sys.platform == 'darwin' or os.name != 'posix':
             return
-        oldest_time = datetime.now() - delta
-        self._logger.debug('Checking %s for files older than %s', dirname, oldest_time)
-        count = 0
-        for dirpath, _, filenames in os.walk(dirname):
-            for ent in filenames:
-                curpath = os.path.join(dirpath, ent)
-                file_modified = datetime.fromtimestamp(compare_with_func(curpath))
-                if file_modified < oldest_time:
-                    self._logger.debug('Trashing: %s', curpath)
+        data_home = os.path.expanduser(os.environ.get('XDG_DATA_HOME', '~/.local/share'))
+        for subdir in ('files', 'info'):
+            path = os.path.join(data_home, 'Trash', subdir)
+            try:
+                os.makedirs(path, 0o700)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    self._logger.warn('Unable to create %s: %s', path, ex)
+
+    def _dispose_from(self, disposal, results):
+        result = {'trashed': 0, 'bytes': 0, 'errors': 0}
+        while True:
+            item = disposal.get()
+            if item is None:
+                break
+            curpath, size = item
+            self._logger.debug('Trashing: %s', curpath)
+            try:
+                with _trash_lock_for(curpath):
                     send2trash(curpath)
-                    count += 1
-        if count > 0:
-            self._logger.info('Cleaned up %d files', count)
+                result['trashed'] += 1
+                result['bytes'] += size
+            except Exception as ex:
+                self._logger.warn('Unable to trash %s: %s', curpath, ex)
+                result['errors'] += 1
+        results.append(result)
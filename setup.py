@@ -14,6 +14,7 @@ requirements = [
     'Click>=6.0',
     'python-crontab>=2.1.1',
     'send2trash>=1.3.0',
+    'scandir>=1.5;python_version<"3.5"',
 ]
 
 test_requirements = [
@@ -8,6 +8,9 @@ test_garbagetruck
 Tests for `garbagetruck` module.
 """
 
+import os
+import sys
+import time
 import pytest
 
 from contextlib import contextmanager
@@ -17,6 +20,32 @@ from garbagetruck import garbagetruck
 from garbagetruck import cli
 
 
+@pytest.fixture
+def truck(monkeypatch, tmpdir):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    crontab = garbagetruck.CronTab
+    monkeypatch.setattr(garbagetruck, 'CronTab', lambda user: crontab(tab=''))
+    return garbagetruck.GarbageTruck()
+
+
+@pytest.fixture
+def trashed(monkeypatch):
+    paths = []
+    monkeypatch.setattr(garbagetruck, 'send2trash', paths.append)
+    return paths
+
+
+def make_files(root, count, old_every=3):
+    old = time.time() - 365 * 24 * 60 * 60
+    expected = []
+    for i in range(count):
+        path = root.join('sub%d' % (i % 4)).ensure('file%d' % i)
+        if i % old_every == 0:
+            os.utime(str(path), (old, old))
+            expected.append(str(path))
+    return expected
+
+
 class TestGarbagetruck(object):
 
     @classmethod
@@ -34,6 +63,235 @@ class TestGarbagetruck(object):
         assert help_result.exit_code == 0
         assert 'Show this message and exit.' in help_result.output
 
+    def test_run_job_trashes_old_files(self, truck, trashed, tmpdir):
+        expected = make_files(tmpdir.mkdir('tree'), 50)
+        stats = truck._run_job('st_atime', garbagetruck.timedelta(days=90),
+                               str(tmpdir.join('tree')), workers=3)
+        assert sorted(trashed) == sorted(expected)
+        assert stats == {'scanned': 50, 'trashed': len(expected), 'bytes': 0, 'errors': 0,
+                         'in_use': 0}
+
+    @pytest.mark.skipif(not os.path.isdir('/proc'), reason='requires /proc')
+    def test_run_job_skips_open_and_recently_written_files(self, truck, trashed, tmpdir):
+        expected = make_files(tmpdir.mkdir('tree'), 3, old_every=1)
+        old = time.time() - 365 * 24 * 60 * 60
+        os.utime(expected.pop(), (old, time.time()))
+        with open(expected.pop()) as held_open:
+            stats = truck._run_job('st_atime', garbagetruck.timedelta(days=90),
+                                   str(tmpdir.join('tree')), open_files=truck._open_files())
+        assert trashed == expected
+        assert stats['in_use'] == 1
+
+    def test_scan_bounds_open_directories(self, truck, tmpdir, monkeypatch):
+        path = tmpdir
+        for depth in range(50):
+            path = path.mkdir('d')
+            path.ensure('f')
+        scandir = garbagetruck.scandir
+        open_dirs = []
+        class TrackedScandir(object):
+            def __init__(self, dirpath):
+                assert len(open_dirs) < 4
+                open_dirs.append(dirpath)
+                self.dirpath = dirpath
+                self.entries = scandir(dirpath)
+            def __iter__(self):
+                return self
+            def __next__(self):
+                return next(self.entries)
+            next = __next__
+            def close(self):
+                open_dirs.remove(self.dirpath)
+                self.entries.close()
+        monkeypatch.setattr(garbagetruck, 'scandir', TrackedScandir)
+        monkeypatch.setattr(garbagetruck.GarbageTruck, '_SCAN_OPEN_DIRS', 4)
+        stats = {'errors': 0}
+        assert len(list(truck._scan(str(tmpdir.join('d')), stats))) == 50
+        assert stats['errors'] == 0 and open_dirs == []
+        scan = truck._scan(str(tmpdir.join('d')), stats)
+        next(scan)
+        scan.close()
+        assert open_dirs == []
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'), reason='freedesktop trash only')
+    def test_run_job_trashes_same_named_files_without_loss(self, truck, tmpdir, monkeypatch):
+        plat_other = pytest.importorskip('send2trash.plat_other')
+        data_home = tmpdir.join('share')
+        monkeypatch.setenv('XDG_DATA_HOME', str(data_home))
+        monkeypatch.setattr(plat_other, 'XDG_DATA_HOME', str(data_home).encode())
+        monkeypatch.setattr(plat_other, 'HOMETRASH_B', str(data_home.join('Trash')).encode())
+        monkeypatch.setattr(plat_other, 'HOMETRASH', str(data_home.join('Trash')))
+        monkeypatch.setattr(garbagetruck, 'send2trash', plat_other.send2trash)
+        old = time.time() - 365 * 24 * 60 * 60
+        for i in range(500):
+            path = tmpdir.join('tree', 'd%d' % i).ensure('same.log')
+            path.write(str(i))
+            os.utime(str(path), (old, old))
+        stats = truck._run_job('st_atime', garbagetruck.timedelta(days=90),
+                               str(tmpdir.join('tree')), workers=8)
+        assert stats['trashed'] == 500 and stats['errors'] == 0
+        trashed = data_home.join('Trash', 'files').listdir()
+        assert sorted(int(p.read()) for p in trashed) == list(range(500))
+
+    def test_run_job_survives_disposal_errors(self, truck, monkeypatch, tmpdir):
+        make_files(tmpdir.mkdir('tree'), 10, old_every=1)
+        def fail(path):
+            raise OSError('nope')
+        monkeypatch.setattr(garbagetruck, 'send2trash', fail)
+        monkeypatch.setattr(garbagetruck.GarbageTruck, 'DISPOSAL_QUEUE_SIZE', 1)
+        stats = truck._run_job('st_atime', garbagetruck.timedelta(days=90),
+                               str(tmpdir.join('tree')), workers=1)
+        assert stats['errors'] == 10 and stats['trashed'] == 0
+
+    def test_run_job_records_history(self, truck, trashed, monkeypatch, tmpdir):
+        make_files(tmpdir.mkdir('tree'), 9)
+        truck.set_job('run %s', 'tree', [str(tmpdir.join('tree'))])
+        monkeypatch.setattr(garbagetruck.GarbageTruck, 'HISTORY_LIMIT', 2)
+        section_name = garbagetruck.GarbageTruck._section_name_for('tree')
+        for _ in range(3):
+            truck.run_job(section_name)
+        history = truck.job_history('tree')
+        assert len(history) == 2
+        assert history[0]['scanned'] == 9 and history[0]['trashed'] == 3
+        summary, = truck.stats_jobs()
+        assert summary['name'] == 'tree' and summary['runs'] == 2
+        assert summary['trashed'] == 6 and summary['trend'] is not None
+
+    def test_job_history_skips_truncated_records(self, truck, tmpdir):
+        truck.set_job('run %s', 'tree', [str(tmpdir)])
+        section_name = garbagetruck.GarbageTruck._section_name_for('tree')
+        truck.run_job(section_name)
+        with open(truck._history_fn_for(section_name), 'a') as history_file:
+            history_file.write('{"duration": 1.')
+        truck.run_job(section_name)
+        assert len(truck.job_history('tree')) == 2
+        assert os.listdir(truck._history_dir) == [section_name + '.jsonl']
+
+    def test_apply_jobs_reconciles(self, truck, tmpdir):
+        truck.set_job('run %s', 'keep', [str(tmpdir)])
+        truck.set_job('run %s', 'edit', [str(tmpdir)])
+        truck.set_job('run %s', 'drop', [str(tmpdir)])
+        diff = truck.apply_jobs('run %s', [
+            {'name': 'keep', 'dirs': [str(tmpdir)]},
+            {'name': 'edit', 'dirs': [str(tmpdir)], 'check_every': 'day'},
+            {'name': 'new', 'dirs': [str(tmpdir)]},
+        ])
+        assert diff == {'added': ['new'], 'changed': ['edit'], 'removed': ['drop'],
+                        'unchanged': ['keep']}
+        assert len(list(truck._cron)) == 3
+        diff = truck.apply_jobs('run %s', [{'name': 'keep', 'dirs': [str(tmpdir)]}])
+        assert sorted(diff['removed']) == ['edit', 'new'] and diff['unchanged'] == ['keep']
+
+    def test_apply_jobs_resolves_symlinks_like_set(self, truck, tmpdir):
+        tmpdir.mkdir('real')
+        tmpdir.join('link').mksymlinkto(tmpdir.join('real'))
+        truck.set_job('run %s', 'keep', [os.path.realpath(str(tmpdir.join('link')))])
+        diff = truck.apply_jobs('run %s', [{'name': 'keep', 'dirs': [str(tmpdir.join('link'))]}])
+        assert diff['unchanged'] == ['keep']
+
+    @pytest.mark.parametrize('document', ['{}', 'null', '""', '0'])
+    def test_apply_command_rejects_non_list_documents(self, truck, tmpdir, document):
+        truck.set_job('run %s', 'keep', [str(tmpdir)])
+        truck.save_changes()
+        jobs_file = tmpdir.join('jobs.json')
+        jobs_file.write(document)
+        result = CliRunner().invoke(cli.main, ['--log-file', str(tmpdir.join('log')),
+                                               'apply', '-n', str(jobs_file)])
+        assert result.exit_code == 1 and 'Jobs must be a list' in result.output
+        assert 'removed' not in result.output
+
+    @pytest.mark.parametrize('spec', [
+        'x',
+        {'name': 'x', 'dirs': '~/Downloads'},
+        {'name': 'x', 'dirs': [1]},
+        {'name': 'x', 'dirs': ['/tmp'], 'older': '1 day'},
+        {'name': 'x', 'dirs': ['/tmp'], 'compare_with': 'bogus'},
+        {'name': 'x', 'dirs': ['/tmp'], 'older_than': '1 fortnight'},
+        {'name': 'x', 'dirs': ['/tmp'], 'check_every': '1 fortnight'},
+        {'name': 'x', 'dirs': ['/tmp'], 'check_every': 'year'},
+    ])
+    def test_apply_jobs_rejects_invalid_specs(self, truck, tmpdir, spec):
+        truck.set_job('run %s', 'keep', [str(tmpdir)])
+        with pytest.raises(garbagetruck.GarbageTruck.InvalidJob):
+            truck.apply_jobs('run %s', [spec])
+        assert len(truck._config.sections()) == 1
+        assert len(list(truck._cron)) == 1
+
+    def test_dispatcher_replaces_job_entries(self, truck, tmpdir):
+        truck.set_job('run %s', 'a', [str(tmpdir)])
+        truck.set_job('run %s', 'b', [str(tmpdir)], check_every='day')
+        truck.enable_dispatcher('dispatch')
+        assert [job.command for job in truck._cron] == ['dispatch']
+        truck.set_job('run %s', 'c', [str(tmpdir)])
+        assert [job.command for job in truck._cron] == ['dispatch']
+        truck.disable_dispatcher('run %s')
+        assert len(list(truck._cron)) == 3 and not truck.dispatcher_enabled()
+
+    def test_dispatch_runs_due_jobs(self, truck, trashed, tmpdir):
+        make_files(tmpdir.mkdir('tree'), 3)
+        truck.set_job('run %s', 'a', [str(tmpdir.join('tree'))], check_every='day')
+        truck.set_job('run %s', 'b', [str(tmpdir.join('tree'))], check_every='day')
+        assert len(truck.due_jobs()) == 2
+        truck.dispatch(concurrency=2, jitter=0)
+        assert len(truck.job_history('a')) == 1 and len(truck.job_history('b')) == 1
+        assert truck.due_jobs() == []
+        tomorrow = garbagetruck.datetime.now() + garbagetruck.timedelta(days=1, minutes=1)
+        assert len(truck.due_jobs(now=tomorrow)) == 2
+
+    def test_estimate_extrapolates_uniform_tree(self, truck, tmpdir):
+        make_files(tmpdir.mkdir('tree'), 40, old_every=4)
+        result = truck.estimate([str(tmpdir.join('tree'))], check_every='minute', samples=100)
+        assert result['files'] == 40 and result['dirs'] == 4
+        assert 0 < result['expired_fraction'] < 1
+        assert 0 < result['stats'] <= 100
+        assert result['period_seconds'] == 60
+
+    def test_estimate_bounds_stats_and_walks_every_dir(self, truck, tmpdir):
+        roots = [tmpdir.mkdir('tree%d' % i) for i in range(3)]
+        for root in roots:
+            make_files(root, 40)
+        result = truck.estimate([str(root) for root in roots], samples=2)
+        assert result['walks'] == 3 and result['files'] == 120
+        result = truck.estimate([str(root) for root in roots], samples=13)
+        assert result['stats'] == 13 and result['files'] == 120
+
+    def test_estimate_lists_each_directory_once(self, truck, tmpdir, monkeypatch):
+        make_files(tmpdir.mkdir('tree'), 200)
+        listed = []
+        scandir = garbagetruck.scandir
+        monkeypatch.setattr(garbagetruck, 'scandir',
+                            lambda path: listed.append(path) or scandir(path))
+        result = truck.estimate([str(tmpdir.join('tree'))], samples=500)
+        assert result['files'] == 200
+        assert sorted(listed) == sorted(set(listed)) and len(listed) == 5
+
+    def test_dispatch_starts_jobs_in_jittered_order(self, truck, tmpdir, monkeypatch):
+        for name in ('a', 'b', 'c'):
+            truck.set_job('run %s', name, [str(tmpdir)])
+        offsets = iter([30, 10, 20])
+        monkeypatch.setattr(garbagetruck.random, 'uniform', lambda low, high: next(offsets))
+        monkeypatch.setattr(garbagetruck.time, 'sleep', lambda seconds: None)
+        started = []
+        monkeypatch.setattr(truck, 'run_job', lambda section_name, workers: started.append(
+            section_name))
+        due = truck.due_jobs()
+        truck.dispatch(concurrency=1, jitter=60)
+        assert started == [due[1], due[2], due[0]]
+
+    def test_dispatch_skips_running_jobs(self, truck, trashed, tmpdir):
+        truck.set_job('run %s', 'a', [str(tmpdir)])
+        section_name = garbagetruck.GarbageTruck._section_name_for('a')
+        with truck._lock(section_name) as locked:
+            assert locked
+            assert truck.due_jobs() == []
+            truck.run_job(section_name)
+        assert truck.job_history('a') == []
+        with truck._lock('dispatch'):
+            truck.dispatch(jitter=0)
+        assert truck.job_history('a') == []
+        truck.dispatch(jitter=0)
+        assert len(truck.job_history('a')) == 1
+
     @classmethod
     def teardown_class(cls):
         pass